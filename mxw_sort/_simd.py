@@ -0,0 +1,73 @@
+import functools
+
+import numpy as np
+
+# Flipping the MSB of a uint16 is the same as subtracting 2**15 and reinterpreting as int16
+_U16_SIGN_BIT = np.uint16(0x8000)
+
+
+# uint16 -> int16 (x - 2**15) as one XOR pass, returned as an int16 view of the result.
+# numpy's bitwise_xor loop is vectorized, so this runs at memory bandwidth with no int32 temporary.
+# inplace=True overwrites buf; only use it on buffers nobody else holds.
+def u2s_xor(buf: np.ndarray, inplace: bool = False) -> np.ndarray:
+    if buf.dtype != np.uint16:
+        raise TypeError(f"u2s_xor expects uint16, got {buf.dtype}")
+    out = np.bitwise_xor(buf, _U16_SIGN_BIT, out=buf if inplace else None)
+    return out.view(np.int16)
+
+
+# QC raster points in one pass over the spikes. row_of[c] is the raster row of cluster c (-1: not plotted).
+# Each row keeps a uniform sample of at most x.shape[1] spikes by reservoir sampling (Algorithm R), so no
+# per-unit index arrays are built. seen[r] ends up as the row's total spike count.
+# Sequential on purpose: every row's reservoir depends on the spikes before it.
+def _reservoir_raster(spike_clusters, spike_times, inv_fs, row_of, x, seen, seed):
+    np.random.seed(seed)
+    cap = x.shape[1]
+    n_lut = row_of.shape[0]
+    for i in range(spike_clusters.shape[0]):
+        c = spike_clusters[i]
+        if c < 0 or c >= n_lut:
+            continue
+        r = row_of[c]
+        if r < 0:
+            continue
+        k = seen[r]
+        seen[r] = k + 1
+        if k < cap:
+            x[r, k] = spike_times[i] * inv_fs
+        else:
+            j = np.random.randint(0, k + 1)
+            if j < cap:
+                x[r, j] = spike_times[i] * inv_fs
+
+
+# Compiled on first use: importing numba (and LLVM) isn't free, and most callers of this module never need it
+@functools.cache
+def _reservoir_raster_jit():
+    from numba import njit
+
+    return njit(cache=True, nogil=True)(_reservoir_raster)
+
+
+# Returns (x, y) raster points for the units in chosen_units (sorted): x in seconds (sample * inv_fs),
+# y the unit's row, at most cap spikes per unit, grouped row by row
+def raster_points(
+    spike_clusters: np.ndarray,
+    spike_times: np.ndarray,
+    inv_fs: float,
+    chosen_units: np.ndarray,
+    cap: int,
+    seed: int = 0,
+) -> tuple[np.ndarray, np.ndarray]:
+    n_rows = int(chosen_units.size)
+    row_of = np.full(int(chosen_units.max()) + 1 if n_rows else 0, -1, dtype=np.int64)
+    row_of[chosen_units] = np.arange(n_rows)
+    x = np.empty((n_rows, cap), dtype=np.float64)
+    seen = np.zeros(n_rows, dtype=np.int64)
+    # np.asarray: plain ndarray views of memmaps, which numba types like any other array
+    _reservoir_raster_jit()(
+        np.asarray(spike_clusters), np.asarray(spike_times), float(inv_fs), row_of, x, seen, seed
+    )
+    filled = np.minimum(seen, cap)
+    y = np.repeat(np.arange(n_rows, dtype=np.int32), filled)
+    return x[np.arange(cap) < filled[:, None]], y
@@ -1,7 +1,17 @@
+import os
 from pathlib import Path
+
 import typer
-from .config import PipelineConfig
-from .pipeline import process_h5, process_directory, process_directory_flat
+
+# Before h5py is imported anywhere: HDF5 file locking serializes (or breaks, on NFS) concurrent reads of the
+# same file from parallel wells. Readers also pass locking=False; this covers older h5py and spawned workers.
+os.environ.setdefault("HDF5_USE_FILE_LOCKING", "FALSE")
+from .config import (
+    DEFAULT_H5_CACHE_MB,
+    DEFAULT_IO_CHUNK_DURATION,
+    DEFAULT_IO_N_JOBS,
+    PipelineConfig,
+)
 
 app = typer.Typer(add_completion=False)
 
@@ -24,14 +34,25 @@ def run(
     dur_s: float = typer.Option(30.0, "--dur-s", help="Seconds to process; set 0 to mean full file"),
     wells: str = typer.Option("auto", "--wells", help="Wells to process (e.g., '0-5', '0,2,4', or 'auto' to detect)"),
     only_well: int = typer.Option(None, "--only-well", help="Run exactly one Maxwell well index (0-5)"),
+    preprocess_mode: str = typer.Option("bandpass", "--preprocess-mode", help="'bandpass' (filter before export) or 'raw' (export unfiltered, KS4 highpasses at --bp-min)"),
     bp_min: float = typer.Option(300.0, "--bp-min", help="Bandpass filter min frequency (Hz)"),
     bp_max_frac_nyq: float = typer.Option(0.9, "--bp-max-frac-nyq", help="Bandpass max as fraction of Nyquist"),
-    ks4_hp: float = typer.Option(1.0, "--ks4-highpass-cutoff", help="KS4 highpass cutoff (1.0 = disabled)"),
+    probe_format: str = typer.Option("json", "--probe-format", help="KS4 probe file format: 'json' or 'npz'"),
+    ks4_hp: float = typer.Option(1.0, "--ks4-highpass-cutoff", help="KS4 highpass cutoff (1.0 = disabled). Ignored with --preprocess-mode raw"),
     ks4_batch_size: int = typer.Option(60000, "--ks4-batch-size", help="KS4 batch size"),
+    io_n_jobs: int = typer.Option(DEFAULT_IO_N_JOBS, "--io-n-jobs", help="Parallel workers for the binary export (per well)"),
+    io_chunk_duration: str = typer.Option(DEFAULT_IO_CHUNK_DURATION, "--io-chunk-duration", help="Chunk size per export worker (e.g. '1s', '500ms')"),
+    scratch_dir: Path = typer.Option(None, "--scratch-dir", help="Stage traces.bin on fast local storage (e.g. /dev/shm or $TMPDIR) for KS4; deleted after sorting"),
+    h5_cache_mb: int = typer.Option(DEFAULT_H5_CACHE_MB, "--h5-cache-mb", help="h5py chunk cache per open file (MB); multiplied by --io-n-jobs"),
     flat: bool = typer.Option(False, "--flat", help="Flat directory mode: each h5 file gets its own output folder named after the file"),
     skip_existing: bool = typer.Option(True, "--skip-existing/--no-skip-existing", help="Skip wells with existing KS4 outputs"),
+    n_workers: int = typer.Option(1, "--n-workers", help="Wells processed in parallel per h5 file (KS4 still runs one at a time)"),
     dry_run: bool = typer.Option(False, "--dry-run", help="Print actions without doing any work"),
 ):
+    # Imported here, not at module level: pipeline pulls in SpikeInterface/h5py, which --help and
+    # argument errors shouldn't have to pay for
+    from .pipeline import process_directory, process_directory_flat, process_h5
+
     # Interpret dur_s=0 as "just run the whole recording"
     dur = None if float(dur_s) == 0 else float(dur_s)
 
@@ -39,10 +60,16 @@ def run(
     cfg = PipelineConfig(
         start_s=float(start_s),
         dur_s=dur,
+        preprocess_mode=preprocess_mode,
         bp_min_hz=float(bp_min),
         bp_max_frac_nyq=float(bp_max_frac_nyq),
+        probe_format=probe_format,
         ks4_highpass_cutoff_hz=float(ks4_hp),
         ks4_batch_size=int(ks4_batch_size),
+        io_n_jobs=int(io_n_jobs),
+        io_chunk_duration=str(io_chunk_duration),
+        scratch_dir=scratch_dir,
+        h5_cache_mb=int(h5_cache_mb),
     )
 
     out.mkdir(parents=True, exist_ok=True)
@@ -59,6 +86,7 @@ def run(
                 skip_existing=skip_existing,
                 dry_run=dry_run,
                 only_well=only_well,
+                n_workers=n_workers,
             )
         else:
             process_directory(
@@ -69,6 +97,7 @@ def run(
                 skip_existing=skip_existing,
                 dry_run=dry_run,
                 only_well=only_well,
+                n_workers=n_workers,
             )
     else:
         process_h5(
@@ -79,6 +108,7 @@ def run(
             skip_existing=skip_existing,
             dry_run=dry_run,
             only_well=only_well,
+            n_workers=n_workers,
         )
 
 if __name__ == "__main__":
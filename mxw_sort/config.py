@@ -1,7 +1,18 @@
+import hashlib
+import json
+import os
 from dataclasses import dataclass
+from pathlib import Path
+from typing import Literal
+
+# Half the cores by default, leaves headroom for h5py reads and the rest of the box
+DEFAULT_IO_N_JOBS = max(1, (os.cpu_count() or 2) // 2)
+DEFAULT_IO_CHUNK_DURATION = "2s"
+DEFAULT_H5_CACHE_MB = 512
 
 # Create frozen dataclass for parameters that affect processing results (for reproducibility (fingers crossed)).
-@dataclass(frozen=True)
+# slots: no per-instance __dict__, so smaller instances and pickles (one config is sent with every well task).
+@dataclass(frozen=True, slots=True)
 class PipelineConfig:
 
     # Time selection
@@ -9,9 +20,52 @@ class PipelineConfig:
     dur_s: float | None = 30   # None means full recording
 
     # Preprocessing
+    # "bandpass": filter here, KS4 highpass off. "raw": export unfiltered int16, KS4 highpasses at bp_min_hz.
+    preprocess_mode: Literal["bandpass", "raw"] = "bandpass"
     bp_min_hz: float = 300.0
     bp_max_frac_nyq: float = 0.9  # 0.9 * (fs/2)
 
+    # Export
+    probe_format: Literal["json", "npz"] = "json"  # KS4 probe file. "npz" skips float -> text conversion.
+
     # KS4 settings
-    ks4_highpass_cutoff_hz: float = 1.0  # 1.0 disables (already bandpassed)
+    ks4_highpass_cutoff_hz: float = 1.0  # 1.0 disables (already bandpassed). Ignored in "raw" mode.
     ks4_batch_size: int = 60000
+
+    # Binary export (execution only, doesn't change results)
+    io_n_jobs: int = DEFAULT_IO_N_JOBS
+    io_chunk_duration: str = DEFAULT_IO_CHUNK_DURATION
+    scratch_dir: Path | None = None  # Fast local dir (e.g. /dev/shm, $TMPDIR) to stage traces.bin for KS4. None keeps it in out.
+    h5_cache_mb: int = DEFAULT_H5_CACHE_MB  # h5py chunk cache per open file. RAM cost is per export worker, so ~io_n_jobs * h5_cache_mb.
+
+
+# Fields that change traces.bin. The bandpass fields only count in "bandpass" mode ("raw" exports unfiltered
+# data, bp_min_hz reaches KS4 through ks4_highpass_hz). probe_format only picks which probe file is written
+# from channel_xy.npy, and execution-only fields (io_*, scratch_dir, h5_cache_mb) don't change outputs.
+PREP_FIELDS = ("start_s", "dur_s", "preprocess_mode")
+BANDPASS_FIELDS = ("bp_min_hz", "bp_max_frac_nyq")
+
+# Highpass cutoff KS4 actually runs with. In "raw" mode KS4 does the only highpass pass, at bp_min_hz,
+# and ks4_highpass_cutoff_hz is ignored.
+def ks4_highpass_hz(cfg: PipelineConfig) -> float:
+    return cfg.ks4_highpass_cutoff_hz if cfg.preprocess_mode == "bandpass" else cfg.bp_min_hz
+
+def _digest(values: dict, salt: str = "") -> str:
+    # Numbers as floats so dur_s=30 and dur_s=30.0 hash the same
+    values = {
+        n: float(v) if isinstance(v, (int, float)) and not isinstance(v, bool) else v
+        for n, v in values.items()
+    }
+    payload = salt + json.dumps(values, sort_keys=True)
+    return hashlib.blake2b(payload.encode(), digest_size=16).hexdigest()
+
+# Fingerprint of everything that determines the exported binary
+def prep_fingerprint(cfg: PipelineConfig) -> str:
+    fields = PREP_FIELDS + BANDPASS_FIELDS if cfg.preprocess_mode == "bandpass" else PREP_FIELDS
+    return _digest({n: getattr(cfg, n) for n in fields})
+
+# KS4 outputs depend on the settings KS4 is actually given and on its input data, so this hashes the
+# effective cutoff (not the config field) and chains the prep fingerprint
+def ks4_fingerprint(cfg: PipelineConfig) -> str:
+    ks4_values = {"highpass_cutoff_hz": ks4_highpass_hz(cfg), "batch_size": cfg.ks4_batch_size}
+    return _digest(ks4_values, salt=prep_fingerprint(cfg))
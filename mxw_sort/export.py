@@ -1,40 +1,118 @@
-from pathlib import Path
 import json
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
 import numpy as np
 import spikeinterface.core as sc
+from spikeinterface.core.job_tools import ensure_chunk_size
+from tqdm.auto import tqdm
+
+from .config import DEFAULT_IO_CHUNK_DURATION, DEFAULT_IO_N_JOBS
+from .io_maxwell import _fadvise
+
+# orjson is optional (pip install mxw-sort[fast]): several times faster than stdlib json on float-heavy
+# payloads like the probe, and serializes numpy arrays directly. Both paths return bytes.
+try:
+    import orjson
+
+    def _dumps(obj, indent: bool = False) -> bytes:
+        option = orjson.OPT_SERIALIZE_NUMPY | (orjson.OPT_INDENT_2 if indent else 0)
+        return orjson.dumps(obj, option=option)
+
+except ImportError:
+    orjson = None
+
+    def _json_default(o):
+        if isinstance(o, (np.ndarray, np.generic)):
+            return o.tolist()
+        raise TypeError(f"Object of type {type(o).__name__} is not JSON serializable")
+
+    def _dumps(obj, indent: bool = False) -> bytes:
+        if indent:
+            return json.dumps(obj, indent=2, default=_json_default).encode()
+        return json.dumps(obj, separators=(",", ":"), default=_json_default).encode()
 
 # Export constants
 DEFAULT_DTYPE = "int16"
-DEFAULT_CHUNK_DURATION = "1s" # Saves my PC. Can be increased for HPCs/devices with lots of RAM.
+PROBE_DTYPE = "float32"  # channel positions (channel_xy.npy, probe files), same as KS4 uses internally
+# Same defaults as the pipeline config. Chunks are per worker, so peak RAM ~ n_jobs * chunk. Lower both on small machines.
+DEFAULT_CHUNK_DURATION = DEFAULT_IO_CHUNK_DURATION
+DEFAULT_N_JOBS = DEFAULT_IO_N_JOBS
 
 # Writes spikeinterface recording object to binary format
+# Chunks are read, filtered and cast in parallel workers; each writes its own slice of the file.
+# With a single job, falls back to a prefetching writer instead of SpikeInterface's serial loop.
 def write_binary(
     rec,
     bin_path: Path,
     dtype: str = DEFAULT_DTYPE,
-    chunk_duration: str = DEFAULT_CHUNK_DURATION
+    chunk_duration: str = DEFAULT_CHUNK_DURATION,
+    n_jobs: int = DEFAULT_N_JOBS,
 ):
+    if int(n_jobs) <= 1:
+        _write_binary_prefetch(rec, bin_path, dtype=dtype, chunk_duration=chunk_duration)
+        return
     sc.write_binary_recording(
         rec,
         file_paths=str(bin_path),
         dtype=dtype,
-        n_jobs=1,
+        n_jobs=int(n_jobs),
         chunk_duration=chunk_duration,
         progress_bar=True,
     )
 
+# Single-job export that overlaps fetching chunk i+1 (h5 read -> filter, on a background thread) with
+# casting/writing chunk i. h5py reads and scipy's filters release the GIL, so the stages really overlap
+# and the read latency hides behind the filter. At most two chunks are in memory.
+def _write_binary_prefetch(rec, bin_path: Path, dtype: str, chunk_duration: str):
+    if rec.get_num_segments() != 1:
+        raise ValueError(f"Expected a single-segment recording, got {rec.get_num_segments()} segments")
+    n_samples = rec.get_num_samples(segment_index=0)
+    chunk_size = ensure_chunk_size(rec, chunk_duration=chunk_duration)
+    bounds = [(a, min(a + chunk_size, n_samples)) for a in range(0, n_samples, chunk_size)]
+
+    def fetch(a, b):
+        return rec.get_traces(segment_index=0, start_frame=a, end_frame=b)
+
+    with ThreadPoolExecutor(max_workers=1) as pool, open(bin_path, "wb") as fh:
+        _fadvise(fh.fileno(), "POSIX_FADV_SEQUENTIAL")
+        pending = pool.submit(fetch, *bounds[0]) if bounds else None
+        for i in tqdm(range(len(bounds)), desc="write_binary (prefetch)"):
+            traces = pending.result()
+            if i + 1 < len(bounds):
+                pending = pool.submit(fetch, *bounds[i + 1])
+            traces.astype(dtype, copy=False).tofile(fh)
+
 # Writes maxwell probe/electrode layout to a JSON for Kilosort
+# Compact (no indent): the file is read once by KS4 and indenting 26k-channel arrays is the slow part.
 def write_probe_json(xy: np.ndarray, probe_path: Path):
-    xy = np.asarray(xy)
+    xy = np.asarray(xy, dtype=PROBE_DTYPE)
     n_chan = int(xy.shape[0])
+    # Columns go in as arrays (orjson needs them C-contiguous); _dumps serializes them without tolist()
     probe = {
-        "chanMap": np.arange(n_chan, dtype=int).tolist(),
-        "xc": xy[:, 0].astype(float).tolist(),
-        "yc": xy[:, 1].astype(float).tolist(),
-        "kcoords": np.zeros(n_chan, dtype=int).tolist(),
+        "chanMap": np.arange(n_chan, dtype=np.int64),
+        "xc": np.ascontiguousarray(xy[:, 0]),
+        "yc": np.ascontiguousarray(xy[:, 1]),
+        "kcoords": np.zeros(n_chan, dtype=np.int64),
         "n_chan": n_chan,
     }
-    probe_path.write_text(json.dumps(probe, indent=2))
+    probe_path.write_bytes(_dumps(probe))
+
+# Writes the same probe as write_probe_json to an .npz (no float -> text conversion at all).
+# KS4 can't read .npz itself; run_ks4 loads it and hands KS4 the probe dict.
+def write_probe_npz(xy: np.ndarray, probe_path: Path):
+    xy = np.asarray(xy, dtype=PROBE_DTYPE)
+    n_chan = int(xy.shape[0])
+    # np.savez appends .npz to names without it, write through a handle to keep probe_path exact
+    with open(probe_path, "wb") as f:
+        np.savez(
+            f,
+            chanMap=np.arange(n_chan, dtype=np.int32),
+            xc=xy[:, 0],
+            yc=xy[:, 1],
+            kcoords=np.zeros(n_chan, dtype=np.float32),
+            n_chan=np.int64(n_chan),
+        )
 
 def write_meta_json(meta: dict, meta_path: Path):
-    meta_path.write_text(json.dumps(meta, indent=2))
+    meta_path.write_bytes(_dumps(meta, indent=True))
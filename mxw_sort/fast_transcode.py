@@ -0,0 +1,107 @@
+from pathlib import Path
+
+import numpy as np
+
+from ._simd import u2s_xor
+from .io_maxwell import (
+    _fadvise,
+    _fadvise_h5_sequential,
+    _h5_fd,
+    _open_h5,
+    _resolve_rec_group,
+)
+
+# Target size of one read block. Rounded to whole h5 chunks along time so each chunk is decompressed once.
+DEFAULT_BLOCK_BYTES = 64 * 1024 * 1024
+
+
+# Drops the stored chunks of raw with index in [k0, k1) along the time axis from the page cache. Once transcoded
+# they're never read again, so a large transcode doesn't evict everything else (the output KS4 reads next
+# included). Dropped chunk by chunk, not by file range, so other wells' data in the same file keeps its pages.
+# Returns False when chunk locations aren't available (contiguous layout, old h5py), so the caller stops trying.
+def _drop_read_chunks(raw, fd: int, k0: int, k1: int) -> bool:
+    if raw.chunks is None:
+        return False
+    step = raw.chunks[-1]
+    try:
+        for k in range(k0, k1):
+            if raw.ndim == 2:
+                coords = [(c, k * step) for c in range(0, raw.shape[0], raw.chunks[0])]
+            else:
+                coords = [(k * step,)]
+            for coord in coords:
+                info = raw.id.get_chunk_info_by_coord(coord)
+                if info.byte_offset is not None and info.size:
+                    _fadvise(fd, "POSIX_FADV_DONTNEED", info.byte_offset, info.size)
+    except (AttributeError, KeyError, ValueError):
+        return False
+    return True
+
+
+# Copies the raw Maxwell traces for one well straight from h5 to a KS4 int16 binary (frames x channels).
+# Equivalent to read_maxwell -> unsigned_to_signed -> slice -> write_binary, minus SpikeInterface's per-chunk
+# Python overhead and h5py fancy slicing: blocks are read_direct'ed into preallocated buffers and reused.
+# Only valid without filtering or channel subsetting (preprocess_mode="raw").
+def transcode_raw(
+    h5_path: str,
+    stream_name: str,
+    bin_path: Path,
+    start_f: int = 0,
+    end_f: int | None = None,
+    block_bytes: int = DEFAULT_BLOCK_BYTES,
+):
+    with _open_h5(h5_path) as f:
+        _fadvise_h5_sequential(f)
+        rec_group = _resolve_rec_group(f, stream_name)
+        raw = rec_group["groups/routed/raw"]
+
+        if raw.dtype not in (np.uint16, np.int16):
+            raise ValueError(f"Unsupported raw dtype for transcode: {raw.dtype} (expected uint16 or int16)")
+        unsigned = raw.dtype == np.uint16
+
+        if raw.ndim == 2:
+            n_ch, n_samples = raw.shape
+            chunk_frames = raw.chunks[1] if raw.chunks else 1
+        else:
+            n_ch = rec_group["settings/mapping"].shape[0]
+            n_samples = raw.shape[0] // n_ch
+            chunk_frames = max(1, raw.chunks[0] // n_ch) if raw.chunks else 1
+
+        end_f = n_samples if end_f is None else min(int(end_f), n_samples)
+        start_f = int(start_f)
+        if not 0 <= start_f <= end_f:
+            raise ValueError(f"Bad frame range: start_f={start_f}, end_f={end_f}, n_samples={n_samples}")
+
+        block = max(chunk_frames, (block_bytes // (2 * n_ch)) // chunk_frames * chunk_frames)
+
+        # Read buffer in the file's layout, output buffer in KS4's (frames, channels) layout
+        out = np.empty((block, n_ch), dtype=raw.dtype)
+        if raw.ndim == 2:
+            buf = np.empty((n_ch, block), dtype=raw.dtype)
+
+        # Stored chunks along time are `step` elements long: frames for 2D, samples (frames * n_ch) for 1D
+        h5_fd = _h5_fd(f)
+        scale = 1 if raw.ndim == 2 else n_ch
+        step = raw.chunks[-1] if raw.chunks else 1
+        next_drop = -(-start_f * scale // step)  # first chunk that lies wholly inside the read range
+
+        with open(bin_path, "wb") as fh:
+            _fadvise(fh.fileno(), "POSIX_FADV_SEQUENTIAL")
+            for a in range(start_f, end_f, block):
+                b = min(a + block, end_f)
+                n = b - a
+                if raw.ndim == 2:
+                    raw.read_direct(buf, source_sel=np.s_[:, a:b], dest_sel=np.s_[:, :n])
+                    np.copyto(out[:n], buf[:, :n].T)
+                else:
+                    # Interleaved layout is already frame-major, read straight into the output buffer
+                    raw.read_direct(out.reshape(-1), source_sel=np.s_[a * n_ch : b * n_ch], dest_sel=np.s_[: n * n_ch])
+                if unsigned:
+                    u2s_xor(out[:n], inplace=True)
+                out[:n].view(np.int16).tofile(fh)
+                # Chunks read completely so far (the last, partial one counts once the data ends there)
+                done = -(-b * scale // step) if b == n_samples else b * scale // step
+                if h5_fd is not None and done > next_drop:
+                    if not _drop_read_chunks(raw, h5_fd, next_drop, done):
+                        h5_fd = None
+                    next_drop = done
@@ -1,22 +1,97 @@
+import functools
+import os
+
 import h5py
 import numpy as np
 import spikeinterface.core as sc
 
+from .config import DEFAULT_H5_CACHE_MB
+
+# h5py chunk cache per open recording (DEFAULT_H5_CACHE_MB). The default 1 MB holds less than one Maxwell
+# chunk row, so every get_traces call re-reads and re-decompresses chunks. Costs RAM per open file (and per
+# parallel worker).
+_H5_CACHE_SLOTS = 1_000_003  # prime, ~100x the chunks that fit in the cache
+_H5_CACHE_W0 = 0.75
+
+# Read-only open used by every reader in the package. Parallel well workers (and SpikeInterface's export workers)
+# all open the same file: locking=False stops HDF5 file locks from serializing those opens, or failing outright
+# on NFS, and SWMR mode (which needs libver="latest") is HDF5's supported way to have many readers.
+# Older h5py/HDF5 without these options get a plain open.
+def _open_h5(h5_path, **kwargs):
+    try:
+        return h5py.File(h5_path, "r", locking=False, libver="latest", swmr=True, **kwargs)
+    except (TypeError, ValueError):
+        return h5py.File(h5_path, "r", **kwargs)
+
+
+# Page-cache access-pattern hint (e.g. "POSIX_FADV_SEQUENTIAL"). Linux only; a no-op where posix_fadvise
+# or the advice constant is missing, or the fd doesn't support it.
+def _fadvise(fd: int, advice: str, offset: int = 0, length: int = 0):
+    if not hasattr(os, "posix_fadvise") or not hasattr(os, advice):
+        return
+    try:
+        os.posix_fadvise(fd, offset, length, getattr(os, advice))
+    except OSError:
+        pass
+
+
+# OS file descriptor behind an open h5py file, or None. Needs the default sec2 driver.
+def _h5_fd(f) -> int | None:
+    try:
+        fd = f.id.get_vfd_handle()
+    except Exception:
+        return None
+    return fd if isinstance(fd, int) else None
+
+
+# Hints sequential reads on an open h5py file (doubles kernel readahead)
+def _fadvise_h5_sequential(f):
+    fd = _h5_fd(f)
+    if fd is not None:
+        _fadvise(fd, "POSIX_FADV_SEQUENTIAL")
+
+
+# (file path, stream) -> resolved recording group path, so the well's keys are only listed once per file
+_REC_GROUP_PATHS: dict[tuple[str, str], str] = {}
+
 
 # Resolves the recording group inside a Maxwell h5 file.
 # Handles both layouts:
 #   wells/well000/rec0000/...  (common in multi-well plates)
 #   wells/well000/...          (direct, less common)
 def _resolve_rec_group(f, stream_name):
+    key = (f.filename, stream_name)
+    cached = _REC_GROUP_PATHS.get(key)
+    if cached is not None and cached in f:
+        return f[cached]
     well = f[f"wells/{stream_name}"]
     # Check for rec0000 subgroup (typical multi-well layout)
     rec_keys = sorted(k for k in well.keys() if k.startswith("rec"))
     if rec_keys:
-        return well[rec_keys[0]]
+        group = well[rec_keys[0]]
     # Fall back to direct layout (settings/mapping lives directly under wellXXX)
-    if "settings" in well:
-        return well
-    raise KeyError(f"Cannot find recording data under wells/{stream_name}")
+    elif "settings" in well:
+        group = well
+    else:
+        raise KeyError(f"Cannot find recording data under wells/{stream_name}")
+    _REC_GROUP_PATHS[key] = group.name
+    return group
+
+
+# True when a channel_indices argument selects every channel in order. SpikeInterface passes slice(None)
+# (not None) for full reads, and those should take the plain hyperslab path, not the subset path.
+def _selects_all_channels(channel_indices, n_channels: int) -> bool:
+    if channel_indices is None:
+        return True
+    if isinstance(channel_indices, slice):
+        return channel_indices.indices(n_channels) == (0, n_channels, 1)
+    ci = np.asarray(channel_indices)
+    return (
+        ci.ndim == 1
+        and ci.size == n_channels
+        and np.issubdtype(ci.dtype, np.integer)
+        and np.array_equal(ci, np.arange(n_channels))
+    )
 
 
 # Lazy SpikeInterface recording segment backed by an h5py dataset.
@@ -27,6 +102,10 @@ class _H5Segment(sc.BaseRecordingSegment):
         self._raw = raw_dataset
         self._n_samples = n_samples
         self._2d = raw_dataset.ndim == 2
+        if self._2d:
+            self._n_channels = raw_dataset.shape[0]
+        else:
+            self._n_channels = raw_dataset.shape[0] // n_samples if n_samples else 0
 
     def get_num_samples(self):
         return self._n_samples
@@ -34,13 +113,37 @@ class _H5Segment(sc.BaseRecordingSegment):
     def get_traces(self, start_frame=None, end_frame=None, channel_indices=None):
         start = start_frame or 0
         end = end_frame if end_frame is not None else self._n_samples
-        if self._2d:
-            # Shape (n_channels, n_samples) → read columns, transpose to (n_frames, n_channels)
-            traces = self._raw[:, start:end].T
+        n = max(end - start, 0)
+        # read_direct into an uninitialised buffer instead of dataset[...] slicing, which goes through
+        # h5py's generic selection path and an extra allocation (h5py issue #977).
+        # The buffer is fresh per call on purpose: callers (and unsigned_to_signed) may keep or modify it.
+        if _selects_all_channels(channel_indices, self._n_channels):
+            channel_indices = None
+        if self._2d and channel_indices is not None:
+            # Read only the requested rows. h5py needs increasing, unique indices to do this as one hyperslab
+            # read; unsorted fancy indices fall back to its slow per-point selection (O(k·chunks)).
+            # Sort/dedupe here, then un-permute the (small) result in memory.
+            ci = np.arange(self._raw.shape[0])[channel_indices]
+            ci_sorted, inverse = np.unique(ci, return_inverse=True)
+            buf = np.empty((ci_sorted.size, n), dtype=self._raw.dtype)
+            if n and ci_sorted.size:
+                self._raw.read_direct(buf, source_sel=np.s_[ci_sorted, start:end])
+            if np.array_equal(ci_sorted, ci):
+                return buf.T
+            return buf.T[:, inverse]
+        elif self._2d:
+            # Shape (n_channels, n_samples) → read columns, transpose to (n_frames, n_channels) as a view
+            buf = np.empty((self._raw.shape[0], n), dtype=self._raw.dtype)
+            if n:
+                self._raw.read_direct(buf, source_sel=np.s_[:, start:end])
+            traces = buf.T
         else:
-            # Shape (n_total,) → interleaved, reshape to (n_frames, n_channels)
-            n_ch = self._raw.shape[0] // self._n_samples
-            traces = self._raw[start * n_ch : end * n_ch].reshape(-1, n_ch)
+            # Shape (n_total,) → interleaved, reshape to (n_frames, n_channels) as a view
+            n_ch = self._n_channels
+            buf = np.empty(n * n_ch, dtype=self._raw.dtype)
+            if n:
+                self._raw.read_direct(buf, source_sel=np.s_[start * n_ch : end * n_ch])
+            traces = buf.reshape(-1, n_ch)
         if channel_indices is not None:
             traces = traces[:, channel_indices]
         return traces
@@ -49,8 +152,14 @@ class _H5Segment(sc.BaseRecordingSegment):
 # SpikeInterface BaseRecording backed by a Maxwell .raw.h5 file via h5py.
 # Bypasses Neo's channel-uniqueness check that fails on some Maxwell files.
 class MaxwellH5Recording(sc.BaseRecording):
-    def __init__(self, h5_path: str, stream_name: str):
-        self._h5_file = h5py.File(h5_path, "r")
+    def __init__(self, h5_path: str, stream_name: str, cache_mb: int = DEFAULT_H5_CACHE_MB):
+        self._h5_file = _open_h5(
+            h5_path,
+            rdcc_nbytes=int(cache_mb) * 1024 * 1024,
+            rdcc_nslots=_H5_CACHE_SLOTS,
+            rdcc_w0=_H5_CACHE_W0,
+        )
+        _fadvise_h5_sequential(self._h5_file)
         rec_group = _resolve_rec_group(self._h5_file, stream_name)
 
         mapping = rec_group["settings/mapping"][()]
@@ -70,19 +179,27 @@ class MaxwellH5Recording(sc.BaseRecording):
         # NOT array indices into the mapping. Look up by channel ID.
         channels_ds = rec_group["groups/routed"].get("channels")
         if channels_ds is not None:
-            chan_ids = channels_ds[()].astype(int)
-            # Build lookup: channel ID → mapping row index
-            chan_to_row = {int(m["channel"]): i for i, m in enumerate(mapping)}
-            row_idx = np.array([chan_to_row[c] for c in chan_ids])
-            xy = np.column_stack([
-                mapping["x"][row_idx].astype(float),
-                mapping["y"][row_idx].astype(float),
-            ])
+            chan_ids = channels_ds[()].astype(np.int64)
+            # Lookup channel ID → mapping row index: sort the mapping IDs once, binary-search all channels.
+            # Duplicate IDs in the mapping resolve to the last row (side="right" on a stable sort).
+            mapping_chans = mapping["channel"].astype(np.int64)
+            order = np.argsort(mapping_chans, kind="stable")
+            sorted_chans = mapping_chans[order]
+            pos = np.searchsorted(sorted_chans, chan_ids, side="right") - 1
+            if sorted_chans.size == 0:
+                raise KeyError("settings/mapping is empty")
+            missing = (pos < 0) | (sorted_chans[pos] != chan_ids)
+            if np.any(missing):
+                raise KeyError(f"Channel IDs not found in settings/mapping: {chan_ids[missing][:10].tolist()}")
+            row_idx = order[pos]
         else:
-            xy = np.column_stack([
-                mapping["x"].astype(float),
-                mapping["y"].astype(float),
-            ])
+            row_idx = np.arange(mapping.shape[0])
+
+        # Pull x/y out of the structured (AoS) mapping once, straight into a float32 (n, 2) array.
+        # float32 is what KS4 uses for probe coordinates anyway.
+        xy = np.empty((row_idx.size, 2), dtype=np.float32)
+        xy[:, 0] = mapping["x"][row_idx]
+        xy[:, 1] = mapping["y"][row_idx]
 
         channel_ids = np.arange(n_channels_raw)
         super().__init__(sampling_frequency=fs, channel_ids=channel_ids, dtype=raw.dtype)
@@ -91,6 +208,9 @@ class MaxwellH5Recording(sc.BaseRecording):
         self.add_recording_segment(segment)
         self.set_channel_locations(xy)
 
+        # Lets SpikeInterface re-open the file inside parallel write_binary workers
+        self._kwargs = {"h5_path": str(h5_path), "stream_name": stream_name, "cache_mb": int(cache_mb)}
+
     def __del__(self):
         if hasattr(self, "_h5_file") and self._h5_file:
             self._h5_file.close()
@@ -98,14 +218,29 @@ class MaxwellH5Recording(sc.BaseRecording):
 
 # Reads maxwell recording from an H5 file, returns SpikeInterface recording object.
 # Uses h5py directly to avoid Neo's duplicate-channel-ID error.
-def read_maxwell(h5_path: str, stream_name: str):
-    return MaxwellH5Recording(h5_path, stream_name)
+def read_maxwell(h5_path: str, stream_name: str, cache_mb: int = DEFAULT_H5_CACHE_MB):
+    return MaxwellH5Recording(h5_path, stream_name, cache_mb=cache_mb)
+
+
+# File modification time, part of the metadata cache keys so a rewritten file is re-read
+def _mtime_ns(h5_path: str) -> int:
+    return os.stat(h5_path).st_mtime_ns
 
 
 # Auto-detects available wells in a Maxwell H5 file, returns a tuple of well indices
+# Cached per (path, mtime): directory listing, process_h5 and dry runs all ask for the same file.
 def get_available_wells(h5_path: str) -> tuple[int, ...]:
     try:
-        with h5py.File(h5_path, "r") as f:
+        mtime_ns = _mtime_ns(h5_path)
+    except OSError:
+        return (0, 1, 2, 3, 4, 5)
+    return _get_available_wells(str(h5_path), mtime_ns)
+
+
+@functools.lru_cache(maxsize=None)
+def _get_available_wells(h5_path: str, mtime_ns: int) -> tuple[int, ...]:
+    try:
+        with _open_h5(h5_path) as f:
             if "wells" not in f:
                 return (0, 1, 2, 3, 4, 5)
             wells = []
@@ -121,8 +256,14 @@ def get_available_wells(h5_path: str) -> tuple[int, ...]:
 
 
 # Returns recording duration in seconds for a given well, reading only metadata.
+# Cached per (path, mtime, stream) like get_available_wells.
 def get_well_duration_s(h5_path: str, stream_name: str) -> float:
-    with h5py.File(h5_path, "r") as f:
+    return _get_well_duration_s(str(h5_path), _mtime_ns(h5_path), stream_name)
+
+
+@functools.lru_cache(maxsize=None)
+def _get_well_duration_s(h5_path: str, mtime_ns: int, stream_name: str) -> float:
+    with _open_h5(h5_path) as f:
         rec_group = _resolve_rec_group(f, stream_name)
         raw = rec_group["groups/routed/raw"]
         fs = float(rec_group["settings/sampling"][()].item())
@@ -1,5 +1,14 @@
 from pathlib import Path
-from kilosort import run_kilosort, DEFAULT_SETTINGS
+
+import numpy as np
+
+
+# Loads a probe written by export.write_probe_npz into the dict format KS4 expects
+def _load_probe_npz(probe_path: Path) -> dict:
+    with np.load(probe_path, allow_pickle=False) as npz:
+        probe = {k: npz[k] for k in npz.files}
+    probe["n_chan"] = int(probe["n_chan"])
+    return probe
 
 # Runs KS4
 def run_ks4(
@@ -11,6 +20,9 @@ def run_ks4(
     batch_size: int,
     highpass_cutoff_hz: float,
 ):
+    # Deferred: kilosort imports torch, only pay for it when a sort actually runs
+    from kilosort import DEFAULT_SETTINGS, run_kilosort
+
     settings = DEFAULT_SETTINGS.copy()
     settings["filename"] = str(bin_file)
     settings["probe_path"] = str(probe_path)
@@ -22,4 +34,6 @@ def run_ks4(
     settings["batch_size"] = int(batch_size)
     settings["highpass_cutoff"] = float(highpass_cutoff_hz)
 
-    run_kilosort(settings=settings)
+    # KS4 only reads .json/.prb/.mat probe files, pass .npz probes as a dict
+    probe = _load_probe_npz(probe_path) if Path(probe_path).suffix == ".npz" else None
+    run_kilosort(settings=settings, probe=probe)
@@ -1,18 +1,108 @@
-from pathlib import Path
+import hashlib
+import json
+import multiprocessing as mp
+import os
+import shutil
 import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager, nullcontext
+from pathlib import Path
+
 import numpy as np
 
-from .config import PipelineConfig
-from .io_maxwell import read_maxwell, get_available_wells, get_well_duration_s
-from .preprocess import unsigned_to_signed, slice_seconds, bandpass_to_frac_nyq
-from .export import write_binary, write_probe_json, write_meta_json
+from .config import PipelineConfig, ks4_fingerprint, ks4_highpass_hz, prep_fingerprint
+from .export import (
+    PROBE_DTYPE,
+    write_binary,
+    write_meta_json,
+    write_probe_json,
+    write_probe_npz,
+)
+from .fast_transcode import transcode_raw
+from .io_maxwell import get_available_wells, get_well_duration_s, read_maxwell
 from .ks4 import run_ks4
+from .preprocess import (
+    bandpass_to_frac_nyq,
+    seconds_to_frames,
+    slice_seconds,
+    unsigned_to_signed,
+)
 from .qc import write_qc
 
+PREP_FINGERPRINT = "preprocessed.fingerprint"
+KS4_FINGERPRINT = "ks4.fingerprint"
+
+# Fingerprint files are written last, after their stage finished, and removed before a stage reruns,
+# so a match means complete outputs made with the same settings
+def _fingerprint_matches(path: Path, fingerprint: str) -> bool:
+    try:
+        return path.read_text().strip() == fingerprint
+    except OSError:
+        return False
+
+# The probe file isn't checked: it's rebuilt from channel_xy.npy when reusing, so a probe format switch
+# doesn't cost a re-export
+def _prep_done(prep_dir: Path, fingerprint: str) -> bool:
+    return (
+        (prep_dir / "traces.bin").exists()
+        and (prep_dir / "channel_xy.npy").exists()
+        and (prep_dir / "meta.json").exists()
+        and _fingerprint_matches(prep_dir / PREP_FINGERPRINT, fingerprint)
+    )
+
+def _ks4_done(ks_dir: Path, fingerprint: str) -> bool:
+    return (
+        (ks_dir / "spike_times.npy").exists()
+        and (ks_dir / "spike_clusters.npy").exists()
+        and _fingerprint_matches(ks_dir / KS4_FINGERPRINT, fingerprint)
+    )
+
+# Short content hash of the channel geometry, to spot geometry changes cheaply. Each geometry file
+# (channel_xy.npy, ks4_probe.json, ks4_probe.npz) gets its own "<name>.xyhash" sidecar, written after the file,
+# so switching probe formats between runs can't leave a stale probe looking current.
+def _xy_hash(xy: np.ndarray) -> str:
+    return hashlib.blake2b(np.ascontiguousarray(xy).tobytes(), digest_size=8).hexdigest()
+
+def _xy_hash_path(path: Path) -> Path:
+    return path.with_name(path.name + ".xyhash")
 
-def _ks4_done(ks_dir: Path) -> bool:
-    # dummy way to check if ks4 has completed its run
-    return (ks_dir / "spike_times.npy").exists() and (ks_dir / "spike_clusters.npy").exists()
+def _xy_current(path: Path, xy_hash: str) -> bool:
+    return path.exists() and _fingerprint_matches(_xy_hash_path(path), xy_hash)
+
+def _write_probe(xy: np.ndarray, probe_path: Path, xy_hash: str):
+    if probe_path.suffix == ".npz":
+        write_probe_npz(xy, probe_path)
+    else:
+        write_probe_json(xy, probe_path)
+    _xy_hash_path(probe_path).write_text(xy_hash)
+
+# Where traces.bin lives for one well run. With a scratch dir (node-local NVMe, /dev/shm, ...) the bin is
+# written there so KS4's repeated reads skip the (often networked) output tree; it's deleted afterwards.
+@contextmanager
+def _staged_bin_path(prep_dir: Path, scratch_dir: Path | None):
+    if scratch_dir is None:
+        yield prep_dir / "traces.bin"
+        return
+    # A bin left in prep_dir by an earlier unstaged run no longer matches meta.json or ks4/, drop it
+    (prep_dir / "traces.bin").unlink(missing_ok=True)
+    stage_dir = Path(scratch_dir) / f"mxw-sort-{uuid.uuid4().hex}"
+    stage_dir.mkdir(parents=True)
+    try:
+        yield stage_dir / "traces.bin"
+    finally:
+        shutil.rmtree(stage_dir, ignore_errors=True)
+
+# Shared GPU lock, set in each worker process by _init_worker. None when wells run serially.
+_KS4_LOCK = None
+
+def _init_worker(ks4_lock):
+    global _KS4_LOCK
+    _KS4_LOCK = ks4_lock
+
+def _ks4_guard():
+    # Only one KS4 instance on the GPU at a time; preprocessing/export still overlaps across workers
+    return _KS4_LOCK if _KS4_LOCK is not None else nullcontext()
 
 def process_one_well(
     h5_path: str,
@@ -23,7 +113,7 @@ def process_one_well(
     dry_run: bool = False,
 ):
     """
-    Modular single-well processing pipeline, wells run serially.
+    Modular single-well processing pipeline. Wells run serially, or in worker processes via process_h5(n_workers > 1).
 
     But what are we looking at?
 
@@ -38,13 +128,19 @@ def process_one_well(
         out_root: Root dir for outputs 
         cfg: Pipeline configuration
         well_idx: Well index (0-5)
-        skip_existing: Skip if KS4 outputs already exist
+        skip_existing: Skip if KS4 outputs from the same settings exist, and reuse a matching
+            preprocessed binary when only KS4 settings changed
         dry_run: Print only actions, without executing
             
     Raises:
         FileNotFoundError: If the h5_path doesn't exist
-        ValueError: If well_idx is invalid
+        ValueError: If well_idx is invalid, or cfg.preprocess_mode / cfg.probe_format is unknown
     """
+    if cfg.preprocess_mode not in ("bandpass", "raw"):
+        raise ValueError(f"Unknown preprocess_mode: {cfg.preprocess_mode!r} (expected 'bandpass' or 'raw')")
+    if cfg.probe_format not in ("json", "npz"):
+        raise ValueError(f"Unknown probe_format: {cfg.probe_format!r} (expected 'json' or 'npz')")
+
     stream = f"well{well_idx:03d}"
 
     well_dir = out_root / stream
@@ -53,15 +149,21 @@ def process_one_well(
     qc_dir = well_dir / "qc"
 
     bin_path = prep_dir / "traces.bin"
-    probe_path = prep_dir / "ks4_probe.json"
+    probe_path = prep_dir / f"ks4_probe.{cfg.probe_format}"
     xy_path = prep_dir / "channel_xy.npy"
     meta_path = prep_dir / "meta.json"
 
-    if skip_existing and _ks4_done(ks_dir):
+    prep_fp = prep_fingerprint(cfg)
+    ks4_fp = ks4_fingerprint(cfg)
+
+    if skip_existing and _ks4_done(ks_dir, ks4_fp):
         print(f"[SKIP] {h5_path} {stream} (ks4 outputs exist)")
         return
 
-    print(f"[RUN] {h5_path} {stream} -> {well_dir}")
+    # A staged (scratch) binary is deleted after each run, so there's never one to reuse
+    reuse_prep = skip_existing and cfg.scratch_dir is None and _prep_done(prep_dir, prep_fp)
+
+    print(f"[RUN] {h5_path} {stream} -> {well_dir}" + (" (reusing preprocessed)" if reuse_prep else ""))
 
     if dry_run:
         try:
@@ -69,8 +171,13 @@ def process_one_well(
             print(f"  duration: {dur:.1f}s")
         except Exception:
             print("  duration: unknown")
-        print("  (dry-run) would write:", bin_path)
-        print("  (dry-run) would write:", probe_path)
+        if reuse_prep:
+            print("  (dry-run) would reuse:", bin_path)
+            if not probe_path.exists():
+                print("  (dry-run) would write:", probe_path)
+        else:
+            print("  (dry-run) would write:", bin_path if cfg.scratch_dir is None else Path(cfg.scratch_dir) / "<tmp>" / bin_path.name)
+            print("  (dry-run) would write:", probe_path)
         print("  (dry-run) would run ks4 into:", ks_dir)
         print("  (dry-run) would write qc into:", qc_dir)
         return
@@ -81,43 +188,82 @@ def process_one_well(
     ks_dir.mkdir(parents=True, exist_ok=True)
     qc_dir.mkdir(parents=True, exist_ok=True)
 
-    # Read h5, run preprocessers
-    rec = read_maxwell(h5_path, stream)
-    rec = unsigned_to_signed(rec)
-    rec = slice_seconds(rec, cfg.start_s, cfg.dur_s)
-    rec = bandpass_to_frac_nyq(rec, cfg.bp_min_hz, cfg.bp_max_frac_nyq)
-
-    # Get sampling frequency from the actual data
-    fs_hz = rec.get_sampling_frequency()
-
-    # Export binary, export channel xy's
-    write_binary(rec, bin_path)
-    xy = rec.get_channel_locations()
-    np.save(xy_path, xy)
-    write_probe_json(xy, probe_path)
-
-    meta = {
-        "h5": h5_path,
-        "stream": stream,
-        "fs_hz": float(fs_hz),
-        "start_s": cfg.start_s,
-        "dur_s": cfg.dur_s,
-        "bp_min_hz": cfg.bp_min_hz,
-        "bp_max_frac_nyq": cfg.bp_max_frac_nyq,
-        "n_chan": int(xy.shape[0]),
-    }
-    write_meta_json(meta, meta_path)
-
-    # Run KS4 (AVOID double highpass filtering, triple check preprocess, export, and config)
-    run_ks4(
-        bin_file=bin_path,
-        probe_path=probe_path,
-        out_dir=ks_dir,
-        fs_hz=float(fs_hz),
-        n_chan=int(xy.shape[0]),
-        batch_size=cfg.ks4_batch_size,
-        highpass_cutoff_hz=cfg.ks4_highpass_cutoff_hz,
-    )
+    # In "raw" mode KS4 does the only highpass pass
+    ks4_hp = ks4_highpass_hz(cfg)
+
+    # Invalidate before rerunning a stage, so an interrupted run is never mistaken for a finished one
+    (ks_dir / KS4_FINGERPRINT).unlink(missing_ok=True)
+
+    # Binary goes to prep_dir, or to a throwaway folder under cfg.scratch_dir (removed once KS4 is done)
+    staged = nullcontext(bin_path) if reuse_prep else _staged_bin_path(prep_dir, cfg.scratch_dir)
+    with staged as bin_path:
+        if reuse_prep:
+            # Only KS4 settings or the probe format changed (or KS4 never finished): skip straight to the sort
+            meta = json.loads(meta_path.read_text())
+            fs_hz = float(meta["fs_hz"])
+            n_chan = int(meta["n_chan"])
+            if not _xy_current(probe_path, meta["xy_hash"]):
+                _write_probe(np.load(xy_path), probe_path, meta["xy_hash"])
+        else:
+            (prep_dir / PREP_FINGERPRINT).unlink(missing_ok=True)
+
+            # Read h5, run preprocessers
+            rec = read_maxwell(h5_path, stream, cache_mb=cfg.h5_cache_mb)
+            rec = unsigned_to_signed(rec)
+            rec = slice_seconds(rec, cfg.start_s, cfg.dur_s)
+            if cfg.preprocess_mode == "bandpass":
+                rec = bandpass_to_frac_nyq(rec, cfg.bp_min_hz, cfg.bp_max_frac_nyq)
+
+            # Get sampling frequency from the actual data
+            fs_hz = rec.get_sampling_frequency()
+
+            # Export binary, export channel xy's
+            if cfg.preprocess_mode == "raw":
+                # Nothing to compute on the traces, copy h5 -> bin directly instead of going through SpikeInterface
+                frames = seconds_to_frames(fs_hz, cfg.start_s, cfg.dur_s) or (0, None)
+                transcode_raw(h5_path, stream, bin_path, *frames)
+            else:
+                write_binary(rec, bin_path, chunk_duration=cfg.io_chunk_duration, n_jobs=cfg.io_n_jobs)
+            xy = rec.get_channel_locations().astype(PROBE_DTYPE, copy=False)
+            n_chan = int(xy.shape[0])
+            xy_hash = _xy_hash(xy)
+            # Geometry rarely changes between reruns, only rewrite xy/probe when it did
+            if not _xy_current(xy_path, xy_hash):
+                np.save(xy_path, xy)
+                _xy_hash_path(xy_path).write_text(xy_hash)
+            if not _xy_current(probe_path, xy_hash):
+                _write_probe(xy, probe_path, xy_hash)
+
+            meta = {
+                "h5": h5_path,
+                "stream": stream,
+                "fs_hz": float(fs_hz),
+                "start_s": cfg.start_s,
+                "dur_s": cfg.dur_s,
+                "preprocess_mode": cfg.preprocess_mode,
+                "bp_min_hz": cfg.bp_min_hz,
+                "bp_max_frac_nyq": cfg.bp_max_frac_nyq,
+                "n_chan": n_chan,
+                "xy_hash": xy_hash,
+                "fingerprint": prep_fp,
+            }
+            write_meta_json(meta, meta_path)
+            # Staged binaries don't outlive this run, so only mark prep_dir reusable when it holds the bin
+            if cfg.scratch_dir is None:
+                (prep_dir / PREP_FINGERPRINT).write_text(prep_fp)
+
+        # Run KS4 (AVOID double highpass filtering, triple check preprocess, export, and config)
+        with _ks4_guard():
+            run_ks4(
+                bin_file=bin_path,
+                probe_path=probe_path,
+                out_dir=ks_dir,
+                fs_hz=float(fs_hz),
+                n_chan=n_chan,
+                batch_size=cfg.ks4_batch_size,
+                highpass_cutoff_hz=ks4_hp,
+            )
+    (ks_dir / KS4_FINGERPRINT).write_text(ks4_fp)
 
     # QC
     dur_s_processed = cfg.dur_s if cfg.dur_s is not None else None # redundant?
@@ -127,7 +273,8 @@ def process_one_well(
     print(f"[DONE] {stream} in {elapsed:.1f}s")
 
 # Process multiple wells from a Maxwell H5 File
-# Multiple wells could be run in parallel in the future. ProcessPoolExecutor would be added around here.
+# With n_workers > 1, wells run in a spawn-context ProcessPoolExecutor (forking would share open h5py handles).
+# KS4 is serialized across workers by a shared semaphore so only one instance holds the GPU.
 def process_h5(
     h5_path: str,
     out_root: Path,
@@ -136,6 +283,7 @@ def process_h5(
     skip_existing: bool = True,
     dry_run: bool = False,
     only_well: int | None = None,
+    n_workers: int = 1,
 ):
     # Handle only_well override
     if only_well is not None:
@@ -145,17 +293,70 @@ def process_h5(
         wells = get_available_wells(h5_path)
         print(f"Auto-detected {len(wells)} wells: {wells}")
 
-    for w in wells:
-        process_one_well(
-            h5_path=h5_path,
-            out_root=out_root,
-            cfg=cfg,
-            well_idx=w,
-            skip_existing=skip_existing,
-            dry_run=dry_run,
-        )
+    n_workers = min(int(n_workers), len(wells))
+    if n_workers <= 1 or dry_run:
+        for w in wells:
+            process_one_well(
+                h5_path=h5_path,
+                out_root=out_root,
+                cfg=cfg,
+                well_idx=w,
+                skip_existing=skip_existing,
+                dry_run=dry_run,
+            )
+        return
+
+    ctx = mp.get_context("spawn")
+    ks4_lock = ctx.BoundedSemaphore(1)
+    with ProcessPoolExecutor(
+        max_workers=n_workers,
+        mp_context=ctx,
+        initializer=_init_worker,
+        initargs=(ks4_lock,),
+    ) as pool:
+        futures = {
+            pool.submit(
+                process_one_well,
+                h5_path=h5_path,
+                out_root=out_root,
+                cfg=cfg,
+                well_idx=w,
+                skip_existing=skip_existing,
+                dry_run=dry_run,
+            ): w
+            for w in wells
+        }
+        # Surface worker errors here; remaining wells keep running
+        failed = []
+        for fut, w in futures.items():
+            try:
+                fut.result()
+            except Exception as e:
+                print(f"[FAIL] {h5_path} well{w:03d}: {e!r}")
+                failed.append(w)
+    if failed:
+        raise RuntimeError(f"{len(failed)} well(s) failed in {h5_path}: {failed}")
 
 
+# Recursive .h5 search with os.scandir: one directory read per folder, no per-file Path objects or stat calls
+# (scandir entries carry the file type). Doesn't descend into symlinked directories, same as rglob.
+def _find_h5_files(root_dir: Path) -> list[str]:
+    found = []
+    stack = [str(root_dir)]
+    while stack:
+        try:
+            it = os.scandir(stack.pop())
+        except PermissionError:
+            continue  # unreadable folder (lost+found, .snapshot, other users' dirs): skip it like rglob did
+        with it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.name.endswith(".h5"):
+                    found.append(entry.path)
+    found.sort()
+    return found
+
 # Recursively finds all .h5 files under a root directory and processes each one
 # Output directories mirror the input directory structure
 def process_directory(
@@ -166,8 +367,9 @@ def process_directory(
     skip_existing: bool = True,
     dry_run: bool = False,
     only_well: int | None = None,
+    n_workers: int = 1,
 ):
-    h5_files = sorted(root_dir.rglob("*.h5"))
+    h5_files = _find_h5_files(root_dir)
     if not h5_files:
         print(f"No .h5 files found under {root_dir}")
         return
@@ -175,15 +377,16 @@ def process_directory(
     print(f"Found {len(h5_files)} .h5 file(s) under {root_dir}:")
     for f in h5_files:
         try:
-            detected = get_available_wells(str(f))
+            detected = get_available_wells(f)
             stream = f"well{detected[0]:03d}" if detected else "well000"
-            dur = get_well_duration_s(str(f), stream)
+            dur = get_well_duration_s(f, stream)
             print(f"  {f}  ({dur:.1f}s)")
         except Exception:
             print(f"  {f}")
     print()
 
-    for h5_file in h5_files:
+    for f in h5_files:
+        h5_file = Path(f)
         file_out = out_root / h5_file.relative_to(root_dir).parent
         file_out.mkdir(parents=True, exist_ok=True)
         process_h5(
@@ -194,6 +397,7 @@ def process_directory(
             skip_existing=skip_existing,
             dry_run=dry_run,
             only_well=only_well,
+            n_workers=n_workers,
         )
 
 
@@ -207,6 +411,7 @@ def process_directory_flat(
     skip_existing: bool = True,
     dry_run: bool = False,
     only_well: int | None = None,
+    n_workers: int = 1,
 ):
     h5_files = sorted(root_dir.glob("*.h5"))
     if not h5_files:
@@ -236,4 +441,5 @@ def process_directory_flat(
             skip_existing=skip_existing,
             dry_run=dry_run,
             only_well=only_well,
+            n_workers=n_workers,
         )
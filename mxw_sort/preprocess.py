@@ -1,7 +1,89 @@
+import numpy as np
+import scipy.signal
 import spikeinterface.preprocessing as spre
+from spikeinterface.core import get_chunk_with_margin
+from spikeinterface.preprocessing.basepreprocessor import (
+    BasePreprocessor,
+    BasePreprocessorSegment,
+)
+
+from ._simd import u2s_xor
+from .io_maxwell import _H5Segment
+
+
+# uint16 -> int16 recording using a sign-bit XOR instead of SpikeInterface's upcast/subtract/downcast.
+# Same values as spre.unsigned_to_signed, one pass and no int32 temporary.
+class UnsignedToSignedXorRecording(BasePreprocessor):
+    def __init__(self, recording):
+        if np.dtype(recording.get_dtype()) != np.uint16:
+            raise TypeError(f"UnsignedToSignedXorRecording expects uint16, got {recording.get_dtype()}")
+        BasePreprocessor.__init__(self, recording, dtype="int16")
+        for parent_segment in recording._recording_segments:
+            self.add_recording_segment(_UnsignedToSignedXorSegment(parent_segment))
+        self._kwargs = dict(recording=recording)
+
+
+class _UnsignedToSignedXorSegment(BasePreprocessorSegment):
+    def __init__(self, parent_recording_segment):
+        BasePreprocessorSegment.__init__(self, parent_recording_segment)
+        # _H5Segment hands out a fresh buffer per call, safe to flip in place
+        self._inplace = isinstance(parent_recording_segment, _H5Segment)
+
+    def get_traces(self, start_frame, end_frame, channel_indices):
+        traces = self.parent_recording_segment.get_traces(start_frame, end_frame, channel_indices)
+        return u2s_xor(traces, inplace=self._inplace)
+
+
+# Same defaults as spre.bandpass_filter: 5th order Butterworth, SOS, forward-backward, 5 ms margins
+BANDPASS_ORDER = 5
+BANDPASS_MARGIN_MS = 5.0
+
+
+# Bandpass filter that runs entirely in float32. spre.bandpass_filter's `dtype` only sets the output type:
+# its float64 SOS coefficients promote every chunk to float64 inside scipy. Here the coefficients are float32
+# (designed once), so sosfiltfilt stays in float32: half the memory traffic, twice the SIMD width.
+# Differences vs the float64 filter are far below one int16 LSB.
+class Float32BandpassRecording(BasePreprocessor):
+    def __init__(self, recording, freq_min: float, freq_max: float, margin_ms: float = BANDPASS_MARGIN_MS, dtype=None):
+        fs = recording.get_sampling_frequency()
+        dtype = np.dtype(dtype if dtype is not None else recording.get_dtype())
+        BasePreprocessor.__init__(self, recording, dtype=dtype)
+        self.annotate(is_filtered=True)
+        if "offset_to_uV" in self.get_property_keys():
+            self.set_channel_offsets(0)
+        sos = scipy.signal.iirfilter(
+            BANDPASS_ORDER, [freq_min, freq_max], btype="bandpass", ftype="butter", output="sos", fs=fs
+        ).astype(np.float32)
+        margin = int(margin_ms * fs / 1000.0)
+        for parent_segment in recording._recording_segments:
+            self.add_recording_segment(_Float32BandpassSegment(parent_segment, sos, margin, dtype))
+        self._kwargs = dict(
+            recording=recording, freq_min=freq_min, freq_max=freq_max, margin_ms=margin_ms, dtype=dtype.str
+        )
+
+
+class _Float32BandpassSegment(BasePreprocessorSegment):
+    def __init__(self, parent_recording_segment, sos, margin, dtype):
+        BasePreprocessorSegment.__init__(self, parent_recording_segment)
+        self.sos = sos
+        self.margin = margin
+        self.dtype = dtype
+
+    def get_traces(self, start_frame, end_frame, channel_indices):
+        traces, left_margin, right_margin = get_chunk_with_margin(
+            self.parent_recording_segment, start_frame, end_frame, channel_indices, self.margin
+        )
+        filtered = scipy.signal.sosfiltfilt(self.sos, traces.astype(np.float32, copy=False), axis=0)
+        filtered = filtered[left_margin : filtered.shape[0] - right_margin]
+        if np.issubdtype(self.dtype, np.integer):
+            np.rint(filtered, out=filtered)
+        return filtered.astype(self.dtype, copy=False)
+
 
 # Converts unsigned integer recording to signed
 def unsigned_to_signed(rec):
+    if np.dtype(rec.get_dtype()) == np.uint16:
+        return UnsignedToSignedXorRecording(rec)
     return spre.unsigned_to_signed(rec)
 
 # Applies a bandpass filter specified as a fraction of the Nyquist frequency, returns filtered recording object
@@ -14,13 +96,19 @@ def bandpass_to_frac_nyq(rec, fmin: float, frac_nyq: float): # Should rec be typ
         fmax = 0.99 * nyq # Double check fmax computation
     if not (0 < fmin < fmax < nyq):
         raise ValueError(f"Bad bandpass: fmin={fmin}, fmax={fmax}, nyq={nyq}")
-    return spre.bandpass_filter(rec, freq_min=fmin, freq_max=fmax)
+    return Float32BandpassRecording(rec, freq_min=fmin, freq_max=fmax)
 
-# Slices the recording by time in seconds, if requested, and returns the sliced recording object
-def slice_seconds(rec, start_s: float, dur_s: float | None):
+# Converts a time window in seconds to (start_frame, end_frame). None means the whole recording.
+def seconds_to_frames(fs_hz: float, start_s: float, dur_s: float | None) -> tuple[int, int] | None:
     if dur_s is None:
-        return rec
-    fs_hz = rec.get_sampling_frequency()
+        return None
     start_f = int(round(start_s * fs_hz))
     end_f = int(round((start_s + dur_s) * fs_hz))
-    return rec.frame_slice(start_f, end_f)
+    return start_f, end_f
+
+# Slices the recording by time in seconds, if requested, and returns the sliced recording object
+def slice_seconds(rec, start_s: float, dur_s: float | None):
+    frames = seconds_to_frames(rec.get_sampling_frequency(), start_s, dur_s)
+    if frames is None:
+        return rec
+    return rec.frame_slice(*frames)
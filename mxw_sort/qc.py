@@ -1,14 +1,116 @@
 from __future__ import annotations
 
-from pathlib import Path
+import functools
 import json
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
 import numpy as np
 
+from ._simd import raster_points
+
+# PNG encoding. zlib level 1 instead of matplotlib's default 6: the plots are mostly flat background,
+# so files grow a little while encoding gets several times faster.
+QC_DPI = 200
+_PNG_KWARGS = {"compress_level": 1}
+
+# Memory-mapped: pages are only read when touched, and most of the QC only looks at subsamples
 def _load_npy(p: Path) -> np.ndarray | None: # Fixes silent error.
     if p.exists():
-        return np.load(p, allow_pickle=False)
+        return np.load(p, allow_pickle=False, mmap_mode="r")
     return None
 
+# Sorted unit ids and their spike counts from one bincount pass (KS cluster ids are small non-negative ints).
+# Per-unit spike lists aren't needed: the raster samples its units in a single compiled pass (raster_points).
+def _unit_counts(spike_clusters: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    counts = np.bincount(spike_clusters)
+    unit_ids = np.flatnonzero(counts)
+    return unit_ids, counts[unit_ids]
+
+# Grid for the density plots (spike positions, drift)
+DENSITY_BINS = 512
+_HIST_CHUNK = 1 << 20  # spikes binned per step, bounds the temporaries when histogramming memmaps
+
+# Plots go through matplotlib's object API: a bare Figure on an Agg canvas, written with print_png to an
+# open file. Skips pyplot's global state and savefig's format dispatch.
+# The plot threads only live for one write_qc call, so no threads are left behind when the next well's
+# export forks its workers.
+_PLOT_THREADS = 3
+
+# matplotlib is imported on first plot, not with the module, and only the Agg canvas is used directly:
+# no pyplot, so no backend autodetection, and the caller's own pyplot backend is left alone
+@functools.cache
+def _agg_classes():
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+
+    return Figure, FigureCanvasAgg
+
+def _new_axes():
+    Figure, FigureCanvasAgg = _agg_classes()
+    fig = Figure(dpi=QC_DPI)
+    FigureCanvasAgg(fig)
+    return fig, fig.add_subplot()
+
+def _save_png(fig, ax, path: Path, xlabel: str, ylabel: str, title: str) -> None:
+    ax.set_xlabel(xlabel)
+    ax.set_ylabel(ylabel)
+    ax.set_title(title)
+    fig.tight_layout()
+    with open(path, "wb") as f:
+        fig.canvas.print_png(f, pil_kwargs=_PNG_KWARGS)
+
+def _scatter_png(path: Path, x, y, s, xlabel: str, ylabel: str, title: str) -> None:
+    fig, ax = _new_axes()
+    ax.scatter(x, y, s=s, marker=".")
+    _save_png(fig, ax, path, xlabel, ylabel, title)
+
+# 2D histogram drawn as one image: cost and file size don't grow with the spike count, and dense regions
+# stay readable where a scatter would saturate
+def _density_png(path: Path, H: np.ndarray, xedges, yedges, cbar_label: str, xlabel: str, ylabel: str, title: str) -> None:
+    img = np.log1p(H.T)
+    fig, ax = _new_axes()
+    im = ax.imshow(
+        img,
+        origin="lower",
+        extent=(xedges[0], xedges[-1], yedges[0], yedges[-1]),
+        aspect="auto",
+        interpolation="nearest",
+        vmin=0.0,
+        vmax=_robust_max(img),
+    )
+    fig.colorbar(im, ax=ax, label=cbar_label, extend="max")
+    _save_png(fig, ax, path, xlabel, ylabel, title)
+
+# 99th percentile of the occupied bins only, so a few hot bins (or outlier amplitudes) don't wash out the
+# rest and the empty background doesn't pull it down. Nearest-rank, no interpolation.
+def _robust_max(img: np.ndarray, q: float = 0.99) -> float | None:
+    vals = img[img > 0]
+    if not vals.size:
+        return None
+    k = int(q * (vals.size - 1))
+    return float(np.partition(vals, k)[k])
+
+def _span(a: np.ndarray) -> tuple[float, float]:
+    return (float(a.min()), float(a.max())) if a.size else (0.0, 1.0)
+
+# np.histogram2d over fixed edges, in chunks. get_x/get_y/get_w map a slice of spikes to values,
+# so memmapped inputs (and derived values like times in seconds) never materialize in full.
+def _histogram2d_chunked(n: int, get_x, get_y, xrange, yrange, get_w=None, bins: int = DENSITY_BINS):
+    H = np.zeros((bins, bins), dtype=np.float64)
+    xedges = yedges = None
+    for a in range(0, n, _HIST_CHUNK):
+        sl = slice(a, min(a + _HIST_CHUNK, n))
+        h, xedges, yedges = np.histogram2d(
+            get_x(sl), get_y(sl), bins=bins, range=(xrange, yrange),
+            weights=None if get_w is None else get_w(sl),
+        )
+        H += h
+    if xedges is None:
+        xedges = np.linspace(*xrange, bins + 1)
+        yedges = np.linspace(*yrange, bins + 1)
+    return H, xedges, yedges
+
 # Create quick QC plots from kilosort outputs, writes raster.png, spike_positions.png, drift_scatter.png, and qc_summary.json
 def write_qc(
     ks_dir: Path,
@@ -28,22 +130,29 @@ def write_qc(
     if spike_times is None or spike_clusters is None:
         raise FileNotFoundError("Missing spike_times.npy or spike_clusters.npy in KS output.")
 
-    # KS stores spike_times as (N, 1)
+    # KS stores spike_times as (N, 1). Reshaping the memmaps is a view, nothing is read here
     spike_times = spike_times.reshape(-1)
     spike_clusters = spike_clusters.reshape(-1)
 
-    t_s = spike_times.astype(np.float64) / float(fs_hz)
+    # Spike times in seconds are only built for the spikes that get plotted, never for the whole array.
+    # Samples -> seconds is always a multiply by the one reciprocal computed here, never a divide;
+    # the ufunc casts to float64 inside its loop, so there's no separate astype pass.
+    inv_fs = 1.0 / float(fs_hz)
+
+    def _t_s(idx):
+        return np.multiply(spike_times[idx], inv_fs, dtype=np.float64)
+
     if dur_s_processed is None:
-        dur_s_processed = float(np.max(t_s)) if t_s.size else 0.0
+        dur_s_processed = float(spike_times.max()) * inv_fs if spike_times.size else 0.0
 
-    unit_ids = np.unique(spike_clusters)
+    unit_ids, unit_counts = _unit_counts(spike_clusters)
     n_units = int(unit_ids.size)
 
     # Basic per-unit firing rates
-    fr_hz = {}
-    for u in unit_ids:
-        n = int(np.sum(spike_clusters == u))
-        fr_hz[int(u)] = (n / dur_s_processed) if dur_s_processed > 0 else 0.0
+    # Only the first 10 units end up in the summary, so only those are computed.
+    inv_dur = 1.0 / dur_s_processed if dur_s_processed > 0 else 0.0
+    rates = unit_counts[:10] * inv_dur
+    fr_hz = {int(u): float(r) for u, r in zip(unit_ids[:10], rates)}
 
     summary = {
         "n_units": n_units,
@@ -52,85 +161,60 @@ def write_qc(
         "fs_hz": float(fs_hz),
         "has_amplitudes": bool(amplitudes is not None),
         "has_spike_positions": bool(spike_positions is not None),
-        "unit_firing_rate_hz_first10": {k: fr_hz[k] for k in list(fr_hz.keys())[:10]},
+        "unit_firing_rate_hz_first10": fr_hz,
     }
-    (qc_dir / "qc_summary.json").write_text(json.dumps(summary, indent=2))
+    with (qc_dir / "qc_summary.json").open("w") as f:
+        json.dump(summary, f, indent=2)
 
     # ---- plots ---- (CHATGPT GENERATED THIS BE WEARY (but it works right now, barring real testing scripts))
-    import matplotlib.pyplot as plt
 
     # Raster: subsample units + spikes to stay light
     rng = np.random.default_rng(0)
-    chosen_units = unit_ids
+    # Sample positions into unit_ids (already sorted) and sort those, so chosen_units comes out sorted
+    pos = np.arange(n_units)
     if n_units > max_units_raster:
-        chosen_units = rng.choice(unit_ids, size=max_units_raster, replace=False)
-        chosen_units = np.sort(chosen_units)
-
-    # Build y indices 0..len(chosen)-1
-    unit_to_y = {int(u): i for i, u in enumerate(chosen_units)}
-
-    xs = []
-    ys = []
-    for u in chosen_units:
-        mask = spike_clusters == u
-        ts = t_s[mask]
-        if ts.size > max_spikes_per_unit:
-            ts = rng.choice(ts, size=max_spikes_per_unit, replace=False)
-        xs.append(ts)
-        ys.append(np.full(ts.size, unit_to_y[int(u)], dtype=np.int32))
-
-    if xs:
-        x = np.concatenate(xs)
-        y = np.concatenate(ys)
-    else:
-        x = np.array([])
-        y = np.array([])
-
-    plt.figure()
-    plt.plot(x, y, linestyle="None", marker=".", markersize=1)
-    plt.xlabel("Time (s)")
-    plt.ylabel("Unit (subset)")
-    plt.title("Raster (subsampled)")
-    plt.tight_layout()
-    plt.savefig(qc_dir / "raster.png", dpi=200)
-    plt.close()
+        pos = rng.choice(n_units, size=max_units_raster, replace=False)
+        pos.sort()
+    chosen_units = unit_ids[pos]
+
+    # One compiled pass over the spikes picks up to max_spikes_per_unit per chosen unit (reservoir sampled),
+    # no per-unit masks, index arrays or temporaries. y is the unit's row 0..len(chosen)-1
+    x, y = raster_points(spike_clusters, spike_times, inv_fs, chosen_units, max_spikes_per_unit)
+
+    # Plot inputs are gathered first and rendered together at the end
+    plots = [(_scatter_png, (qc_dir / "raster.png", x, y, 1, "Time (s)", "Unit (subset)", "Raster (subsampled)"))]
 
     # Spike positions and drift plots
+    # Binned over every spike instead of scattering a subsample
     if spike_positions is not None:
         # Expect shape (N, 2) with columns [x, y] in um (often)
-        spike_positions = np.asarray(spike_positions)
         if spike_positions.ndim == 2 and spike_positions.shape[1] >= 2:
             x_um = spike_positions[:, 0]
             y_um = spike_positions[:, 1]
-
-            # Spike positions scatter (subsample)
-            N = t_s.size
-            keep = np.arange(N)
-            if N > 200_000:
-                keep = rng.choice(keep, size=200_000, replace=False)
-            keep = np.sort(keep)
-
-            plt.figure()
-            plt.plot(x_um[keep], y_um[keep], linestyle="None", marker=".", markersize=1)
-            plt.xlabel("x (um)")
-            plt.ylabel("y (um)")
-            plt.title("Spike positions (subsampled)")
-            plt.tight_layout()
-            plt.savefig(qc_dir / "spike_positions.png", dpi=200)
-            plt.close()
-
-            # Drift scatter: time vs depth (y); optionally size by amplitude
-            plt.figure()
-            if amplitudes is not None and amplitudes.size == t_s.size:
-                amp = np.asarray(amplitudes).reshape(-1)
-                # scale marker sizes gently without specifying colors
-                s = 2 + 8 * (amp - np.min(amp)) / (np.ptp(amp) + 1e-9)
-                plt.scatter(t_s[keep], y_um[keep], s=s[keep], marker=".")
+            N = spike_times.size
+            y_span = _span(y_um)
+
+            # Spike positions density
+            H, xe, ye = _histogram2d_chunked(N, x_um.__getitem__, y_um.__getitem__, _span(x_um), y_span)
+            plots.append((_density_png, (
+                qc_dir / "spike_positions.png", H, xe, ye, "log(1 + spikes)",
+                "x (um)", "y (um)", "Spike positions",
+            )))
+
+            # Drift: time vs depth (y); weighted by amplitude when available
+            if amplitudes is not None and amplitudes.size == N:
+                amp = amplitudes.ravel()  # view for the usual (N,) or contiguous (N, 1) file
+                get_w, cbar_label = amp.__getitem__, "log(1 + summed amplitude)"
             else:
-                plt.plot(t_s[keep], y_um[keep], linestyle="None", marker=".", markersize=1)
-            plt.xlabel("Time (s)")
-            plt.ylabel("y (um)")
-            plt.title("Drift scatter (subsampled)")
-            plt.tight_layout()
-            plt.savefig(qc_dir / "drift_scatter.png", dpi=200)
-            plt.close()
+                get_w, cbar_label = None, "log(1 + spikes)"
+            t_span = (0.0, float(dur_s_processed) or 1.0)
+            H, te, ye = _histogram2d_chunked(N, _t_s, y_um.__getitem__, t_span, y_span, get_w=get_w)
+            plots.append((_density_png, (
+                qc_dir / "drift_scatter.png", H, te, ye, cbar_label,
+                "Time (s)", "y (um)", "Drift",
+            )))
+
+    # The plots are independent; Agg rasterization and PNG encoding are mostly C, so they overlap on threads
+    with ThreadPoolExecutor(max_workers=_PLOT_THREADS, thread_name_prefix="qc-plot") as pool:
+        for fut in [pool.submit(fn, *args) for fn, args in plots]:
+            fut.result()